@@ -1,133 +1,339 @@
+import random
+import struct
+
+import logical
+
+
+_UNDECODED = object()  # Placeholder for a value that is still only in encoded form
+
+
 class BinaryNode:
-    def __init__(self, key, value, left=None, right=None):
+    """A treap node.
+
+    Keys are in search-tree order and no node has a lower priority than its
+    children, which keeps the expected depth logarithmic.
+    """
+
+    __slots__ = ("key", "_value", "_value_string", "left_ref", "right_ref", "priority")
+
+    @classmethod
+    def from_node(cls, node, **kwargs):
+        """Copy node, replacing the fields given as keyword arguments."""
+        if "value" in kwargs:
+            value, value_string = kwargs["value"], None
+        else:
+            value, value_string = node._value, node._value_string
+        return cls(
+            key=kwargs.get("key", node.key),
+            value=value,
+            left_ref=kwargs.get("left_ref", node.left_ref),
+            right_ref=kwargs.get("right_ref", node.right_ref),
+            value_string=value_string,
+            priority=node.priority,
+        )
+
+    def __init__(
+        self, key, value, left_ref, right_ref, value_string=None, priority=None
+    ):
         self.key = key
-        self.value = value
-        self.left = left
-        self.right = right
+        self._value = value
+        self._value_string = value_string  # Encoded form of value, if known
+        self.left_ref = left_ref
+        self.right_ref = right_ref
+        if priority is None:
+            priority = random.getrandbits(32)
+        self.priority = priority
 
+    @property
+    def value(self):
+        """The stored value, decoded the first time it is asked for."""
+        value = self._value
+        if value is _UNDECODED:
+            value = self._value = logical.ValueRef.string_to_referent(
+                self._value_string
+            )
+        return value
 
-class NodeRef:
-    def __init__(self, node=None, address=None):
-        self.node = node
-        self.address = address  # Will be set by storage when persisted
+    def value_string(self):
+        """Return the encoded value, reusing the bytes read from disk if any."""
+        if self._value_string is None:
+            self._value_string = logical.ValueRef.referent_to_string(self._value)
+        return self._value_string
 
-    def __reduce__(self):
-        return (self.__class__, (self.node, self.address))
 
-    def get(self):
-        return self.node
+# Fixed node header: left address, right address, priority, key length,
+# value length. The encoded key and value bytes follow the header.
+_NODE = struct.Struct(">QQIII")
+_NO_ADDRESS = 0xFFFFFFFFFFFFFFFF  # Sentinel for a missing child
 
-    def __str__(self):
-        if self.node:
-            return f"NodeRef(address={self.address}, key={self.node.key}, value={self.node.value})"
-        return f"NodeRef(address={self.address}, node=None)"
 
+class BinaryNodeRef(logical.ValueRef):
+    __slots__ = ()
+
+    def store(self, storage):
+        """Append the unsaved part of this subtree, children first (post-order).
 
-class BinaryTree:
-    def __init__(self, storage):
-        self._storage = storage
-        self.root_ref = None
-        # Load root if it exists
+        Nodes are copy-on-write, so a ref that already has an address heads
+        a subtree that is entirely on disk and is skipped without loading it.
+        Uses an explicit stack so deep or skewed trees do not hit the
+        interpreter recursion limit. Every record is serialized up front
+        and appended with one write_batch call; addresses are assigned from
+        the current end of storage so parents can reference their children.
+        If anything fails before the batch is written, those addresses are
+        cleared again so a later commit cannot point at the missing records.
+        """
+        address = storage.tell()
+        datas = []
+        stored = []
+        stack = [(self, False)]
         try:
-            root_address = (
-                self._storage.get_root_address()
-            )  # Retrieve the root address from storage
-            if root_address is not None:
-                self.root_ref = self._storage.get(
-                    root_address
-                )  # Retrieve the root node from storage
-        except (AttributeError, KeyError):
-            pass  # No root address stored yet, handle gracefully
-
-    def set(self, key, value):
-        """Insert or update a key-value pair in the tree."""
-        if self.root_ref is None:
-            # Tree is empty, create a new root node
-            new_node = BinaryNode(key, value)
-            self.root_ref = NodeRef(new_node)
-            self.root_ref.address = self._storage.set(
-                None, self.root_ref
-            )  # Store root node
-        else:
-            # Find the appropriate position in the tree
-            self._insert(self.root_ref, key, value)
-
-    def _insert(self, node_ref, key, value):
-        """Recursive helper for insertion."""
-        node = node_ref.get()
-        if key == node.key:
-            # Update existing value
-            node.value = value
-            node_ref.address = self._storage.set(
-                node_ref.address, node_ref
-            )  # Update address in storage
-        elif key < node.key:
-            if node.left is None:
-                # Create new left child
-                new_node = BinaryNode(key, value)
-                node.left = NodeRef(new_node)
-                node.left.address = self._storage.set(None, node.left)
-                node_ref.address = self._storage.set(
-                    node_ref.address, node_ref
-                )  # Update address in storage
+            while stack:
+                ref, visited = stack.pop()
+                if ref._address is not None:
+                    continue
+                node = ref._referent
+                if node is None:
+                    continue
+                if visited:
+                    data = ref.referent_to_string(node)
+                    ref._address = address
+                    stored.append(ref)
+                    address += storage.record_size(len(data))
+                    datas.append(data)
+                    continue
+                stack.append((ref, True))
+                stack.append((node.right_ref, False))
+                stack.append((node.left_ref, False))
+            storage.write_batch(datas)
+        except BaseException:
+            for ref in stored:
+                ref._address = None
+            raise
+
+    @staticmethod
+    def referent_to_string(node):
+        """Serialize a node; its children must already have addresses."""
+        key = logical.ValueRef.referent_to_string(node.key)
+        value = node.value_string()
+        left = node.left_ref.address
+        right = node.right_ref.address
+        return (
+            _NODE.pack(
+                _NO_ADDRESS if left is None else left,
+                _NO_ADDRESS if right is None else right,
+                node.priority,
+                len(key),
+                len(value),
+            )
+            + key
+            + value
+        )
+
+    @staticmethod
+    def string_to_referent(string):
+        """Deserialize a node.
+
+        Only the key is decoded here, since that is all a descent compares;
+        the value is decoded on first access and children are loaded lazily
+        by address.
+        """
+        left, right, priority, key_len, value_len = _NODE.unpack_from(string)
+        offset = _NODE.size
+        key = logical.ValueRef.string_to_referent(string[offset : offset + key_len])
+        offset += key_len
+        empty = BinaryNodeRef.EMPTY
+        return BinaryNode(
+            key,
+            _UNDECODED,
+            empty if left == _NO_ADDRESS else BinaryNodeRef(address=left),
+            empty if right == _NO_ADDRESS else BinaryNodeRef(address=right),
+            value_string=bytes(string[offset : offset + value_len]),
+            priority=priority,
+        )
+
+    def __str__(self):
+        if self._referent:
+            return f"BinaryNodeRef(address={self._address}, key={self._referent.key}, value={self._referent.value})"
+        return f"BinaryNodeRef(address={self._address}, node=None)"
+
+
+# Shared ref for missing children. It has neither referent nor address, so
+# get() and store() never modify it.
+BinaryNodeRef.EMPTY = BinaryNodeRef()
+
+
+class BinaryTree(logical.LogicalBase):
+    node_ref_class = BinaryNodeRef
+
+    def _get(self, node, key, default):
+        """Walk down from node looking for key; return default if absent."""
+        follow = self._follow
+        while node is not None:
+            node_key = node.key
+            if key == node_key:
+                return node.value
+            elif key < node_key:
+                node = follow(node.left_ref)
             else:
-                self._insert(node.left, key, value)
-        else:
-            if node.right is None:
-                # Create new right child
-                new_node = BinaryNode(key, value)
-                node.right = NodeRef(new_node)
-                node.right.address = self._storage.set(None, node.right)
-                node_ref.address = self._storage.set(
-                    node_ref.address, node_ref
-                )  # Update address in storage
+                node = follow(node.right_ref)
+        return default
+
+    def _insert(self, node, key, value):
+        """Return a new root ref with key set, copying only the changed path.
+
+        A new leaf is rotated up past ancestors with lower priority.
+        """
+        follow = self._follow
+        path = []
+        append = path.append
+        while node is not None:
+            node_key = node.key
+            if key == node_key:
+                break
+            elif key < node_key:
+                append((node, "L"))
+                node = follow(node.left_ref)
             else:
-                self._insert(node.right, key, value)
-
-    def get(self, key):
-        """Retrieve a value by key."""
-        if self.root_ref is None:
-            return None
-        return self._search(self.root_ref, key)
-
-    def _search(self, node_ref, key):
-        """Recursive helper for search."""
-        if node_ref is None or node_ref.get() is None:
-            return None
-
-        node = node_ref.get()
-        if key == node.key:
-            return node.value
-        elif key < node.key:
-            return self._search(node.left, key)
-        else:
-            return self._search(node.right, key)
-
-    # def commit(self):
-    #     """Persist the entire tree to storage."""
-    #     if self.root_ref:
-    #         # First commit all nodes recursively
-    #         self._commit_node(self.root_ref)
-    #         # Then store the root address
-    #         if hasattr(self._storage, "commit_root_address"):
-    #             self._storage.commit_root_address(self.root_ref.address)
-    def commit(self):
-        if self.root_ref:
-            self._commit_node(self.root_ref)
-            self._storage.commit_root_address(self.root_ref.address)
-            self._storage.flush()  # ← Add this line
-
-    def _commit_node(self, node_ref):
-        """Recursively commit a node and its children."""
-        if node_ref and node_ref.get():
-            # Commit children first (post-order traversal might be better for some cases)
-            if node_ref.get().left:
-                self._commit_node(node_ref.get().left)
-            if node_ref.get().right:
-                self._commit_node(node_ref.get().right)
-            # Commit this node to storage
-            node_ref.address = self._storage.set(node_ref.address, node_ref)
-
-    def __contains__(self, key):
-        """Support for 'in' operator."""
-        return self.get(key) is not None
+                append((node, "R"))
+                node = follow(node.right_ref)
+        if node is not None:
+            new_node = BinaryNode.from_node(node, value=value)
+            return self._rebuild(path, self.node_ref_class(referent=new_node))
+
+        empty = self.node_ref_class.EMPTY
+        child = BinaryNode(key, value, empty, empty)
+        while path and path[-1][0].priority < child.priority:
+            parent, side = path.pop()
+            if side == "L":
+                parent = BinaryNode.from_node(parent, left_ref=child.right_ref)
+                child = BinaryNode.from_node(
+                    child, right_ref=self.node_ref_class(referent=parent)
+                )
+            else:
+                parent = BinaryNode.from_node(parent, right_ref=child.left_ref)
+                child = BinaryNode.from_node(
+                    child, left_ref=self.node_ref_class(referent=parent)
+                )
+        return self._rebuild(path, self.node_ref_class(referent=child))
+
+    def _delete(self, node, key):
+        """Return a new root ref with key removed, copying only the changed path."""
+        follow = self._follow
+        path = []
+        append = path.append
+        while node is not None:
+            node_key = node.key
+            if key == node_key:
+                break
+            elif key < node_key:
+                append((node, "L"))
+                node = follow(node.left_ref)
+            else:
+                append((node, "R"))
+                node = follow(node.right_ref)
+        if node is None:
+            raise KeyError(key)
+
+        return self._rebuild(path, self._merge(node.left_ref, node.right_ref))
+
+    def _merge(self, left_ref, right_ref):
+        """Join two subtrees, every key in left_ref being below those in right_ref.
+
+        The higher-priority root wins at each step, walking down the right
+        spine of the left subtree and the left spine of the right one.
+        """
+        follow = self._follow
+        path = []
+        append = path.append
+        left = follow(left_ref)
+        right = follow(right_ref)
+        while left is not None and right is not None:
+            if left.priority > right.priority:
+                append((left, "R"))
+                left_ref = left.right_ref
+                left = follow(left_ref)
+            else:
+                append((right, "L"))
+                right_ref = right.left_ref
+                right = follow(right_ref)
+        return self._rebuild(path, right_ref if left is None else left_ref)
+
+    def _rebuild(self, path, ref):
+        """Copy the nodes on path bottom-up so they point at the new child ref."""
+        for parent, side in reversed(path):
+            if side == "L":
+                node = BinaryNode.from_node(parent, left_ref=ref)
+            else:
+                node = BinaryNode.from_node(parent, right_ref=ref)
+            ref = self.node_ref_class(referent=node)
+        return ref
+
+    def _iter_nodes(self):
+        """Yield nodes in key order using an explicit stack."""
+        stack = []
+        node = self._follow(self._tree_ref)
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = self._follow(node.left_ref)
+            node = stack.pop()
+            yield node
+            node = self._follow(node.right_ref)
+
+    def compact(self):
+        """Rewrite the tree perfectly balanced and in breadth-first (Eytzinger) order.
+
+        Slot i holds the node whose children sit in slots 2i and 2i + 1, and
+        records are appended in slot order, so the root and upper levels end
+        up next to each other at the start of the new region instead of
+        scattered across the file.
+        """
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        nodes = list(self._iter_nodes())
+        n = len(nodes)
+
+        # In-order walk of the implicit complete tree assigns sorted nodes to slots
+        slots = [None] * (n + 1)
+        it = iter(nodes)
+        stack = []
+        i = 1
+        while stack or i <= n:
+            while i <= n:
+                stack.append(i)
+                i *= 2
+            i = stack.pop()
+            slots[i] = next(it)
+            i = 2 * i + 1
+
+        # Parents sit in lower slots than their children, so handing out
+        # priorities in descending order keeps the heap property
+        priorities = sorted((random.getrandbits(32) for _ in range(n)), reverse=True)
+
+        # Record sizes do not depend on child addresses, so lay out first
+        encoded = [None] * (n + 1)
+        addresses = [None] * (n + 1)
+        address = self._storage.tell()
+        for i in range(1, n + 1):
+            key = logical.ValueRef.referent_to_string(slots[i].key)
+            value = slots[i].value_string()
+            encoded[i] = (key, value)
+            addresses[i] = address
+            address += self._storage.record_size(_NODE.size + len(key) + len(value))
+
+        datas = []
+        for i in range(1, n + 1):
+            key, value = encoded[i]
+            left = addresses[2 * i] if 2 * i <= n else _NO_ADDRESS
+            right = addresses[2 * i + 1] if 2 * i + 1 <= n else _NO_ADDRESS
+            header = _NODE.pack(left, right, priorities[i - 1], len(key), len(value))
+            datas.append(header + key + value)
+        self._storage.write_batch(datas)
+
+        # Drop the old in-memory tree; nodes are reloaded lazily from the new
+        # region. Only switch once it is committed, so a failed write leaves
+        # the tree as it was.
+        root_ref = self.node_ref_class(address=addresses[1] if n else None)
+        self._storage.commit_root_address(root_ref.address)
+        self._tree_ref = root_ref
+        self._storage.unlock()
@@ -3,8 +3,8 @@ import binary_tree
 
 
 class DBDB:
-    def __init__(self, f):
-        self._storage = storage.Storage(f)
+    def __init__(self, f, sync_every=1, durability="sync"):
+        self._storage = storage.Storage(f, sync_every=sync_every, durability=durability)
         self._tree = binary_tree.BinaryTree(self._storage)
         self._closed = False
 
@@ -22,23 +22,38 @@ class DBDB:
 
     def __contains__(self, key):
         self._assert_not_closed()
-        return self._tree.get(key) is not None
+        return key in self._tree
 
     def commit(self):
         self._assert_not_closed()
         self._tree.commit()
 
+    def compact(self):
+        self._assert_not_closed()
+        self._tree.compact()
+
+    def release_lock(self):
+        """Release the lock taken by writes, dropping uncommitted changes."""
+        self._assert_not_closed()
+        self._tree.release_lock()
+
     def close(self):
         if not self._closed:
-            self.commit()
-            self._storage.close()
-            self._closed = True
+            try:
+                self.commit()
+            finally:
+                self._tree.release_lock()
+                self._storage.close()
+                self._closed = True
 
     def _assert_not_closed(self):
         if self._closed:
             raise ValueError("Database is closed.")
 
     def __enter__(self):
+        # Lock once for the whole block rather than once per commit; the lock
+        # is only taken if the block writes, so readers never wait on it
+        self._tree.hold_lock()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -2,25 +2,33 @@ import os
 import dbdb
 
 
-def connect(dbname):
+def connect(dbname, sync_every=1, durability="sync"):
     """Connect to or create a database file.
 
     Args:
         dbname: Path to the database file (string)
+        sync_every: Sync to disk only on every Nth commit (int). Values
+            above 1 trade durability of the latest commits for speed;
+            closing the database always syncs.
+        durability: "sync" (default) or "writeback", which skips every sync
+            until the database is closed; for bulk loads that can be redone
+            if the machine crashes.
 
     Returns:
         DBDB instance
     """
     try:
-        # Try to open in read-write mode first
-        f = open(dbname, "r+b")
-    except FileNotFoundError:
-        # Create the file if it doesn't exist
-        fd = os.open(dbname, os.O_RDWR | os.O_CREAT, 0o644)  # Added file permissions
+        # O_CREAT without O_EXCL opens an existing file as is, so one call
+        # covers both opening and creating
+        fd = os.open(dbname, os.O_RDWR | os.O_CREAT, 0o644)
         f = os.fdopen(fd, "r+b")
     except PermissionError:
         raise PermissionError(f"Permission denied when accessing {dbname}")
     except Exception as e:
         raise IOError(f"Could not open database file {dbname}: {str(e)}")
 
-    return dbdb.DBDB(f)
+    try:
+        return dbdb.DBDB(f, sync_every=sync_every, durability=durability)
+    except Exception:
+        f.close()
+        raise
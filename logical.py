@@ -1,23 +1,146 @@
+# Type tags, compared as ints so decoding never slices the tag out
+_STR, _BYTES, _INT = ord("s"), ord("b"), ord("i")
+
+
+class ValueRef:
+    """A reference to an object stored at an address in storage."""
+
+    __slots__ = ("_referent", "_address")
+
+    def __init__(self, referent=None, address=None):
+        self._referent = referent
+        self._address = address  # Will be set by storage when persisted
+
+    @property
+    def address(self):
+        return self._address
+
+    @staticmethod
+    def referent_to_string(referent):
+        """Encode an object as a one-byte type tag plus payload."""
+        if isinstance(referent, str):
+            return b"s" + referent.encode("utf-8")
+        if isinstance(referent, bytes):
+            return b"b" + referent
+        if type(referent) is int:
+            length = (referent.bit_length() + 8) // 8
+            return b"i" + referent.to_bytes(length, "big", signed=True)
+        # Only other types need pickle, so CLI runs never pay for importing it
+        import pickle
+
+        return b"p" + pickle.dumps(referent)
+
+    @staticmethod
+    def string_to_referent(string):
+        """Inverse of referent_to_string."""
+        tag = string[0]
+        if tag == _STR:
+            return str(string[1:], "utf-8")
+        if tag == _BYTES:
+            return bytes(string[1:])
+        if tag == _INT:
+            return int.from_bytes(string[1:], "big", signed=True)
+        import pickle
+
+        return pickle.loads(string[1:])
+
+    def get(self, storage):
+        """Return the referent, loading it from storage if only the address is known.
+
+        The loaded referent is kept on the ref, so each address is read and
+        decoded at most once for as long as the ref is reachable. Refs do
+        not outlive a refresh after another process commits, though; the
+        address-keyed cache in Storage.load covers the nodes the new root
+        still shares with the old one.
+        """
+        referent = self._referent
+        if referent is not None:
+            return referent
+        if self._address is not None:
+            referent = self._referent = storage.load(
+                self._address, self.string_to_referent
+            )
+        return referent
+
+    def store(self, storage):
+        """Write the referent to storage if it has not been persisted yet."""
+        if self._referent is not None and self._address is None:
+            self._address = storage.write(self.referent_to_string(self._referent))
+
+
+_MISSING = object()  # Returned by lookups for absent keys, since None is a valid value
+
+
 class LogicalBase:
+    node_ref_class = None
+
     def __init__(self, storage):
         self._storage = storage
         self._tree_ref = None
+        self._refresh_tree_ref()
 
     def get(self, key):
+        value = self._find(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._find(key) is not _MISSING
+
+    def _find(self, key):
+        """Return the value stored for key, or _MISSING, without raising."""
         if not self._storage.locked:
             self._refresh_tree_ref()
-        return self._get(self._follow(self._tree_ref), key)
+        return self._get(self._follow(self._tree_ref), key, _MISSING)
 
     def set(self, key, value):
         if self._storage.lock():
             self._refresh_tree_ref()
         self._tree_ref = self._insert(self._follow(self._tree_ref), key, value)
 
+    def delete(self, key):
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        self._tree_ref = self._delete(self._follow(self._tree_ref), key)
+
     def commit(self):
-        self._storage.set_root_address(self._tree_ref.address)
+        """Store unsaved nodes and point the database at the new root.
+
+        Only set() and delete() take the lock, so without it there is nothing
+        to commit, and writing our possibly stale root would undo other
+        processes' commits. A locked tree whose root is already committed is
+        likewise left alone.
+        """
+        storage = self._storage
+        if not storage.locked:
+            return
+        ref = self._tree_ref
+        saved = ref.address is not None or ref._referent is None
+        if saved and ref.address == storage.get_root_address():
+            storage.unlock()
+            return
+        ref.store(storage)
+        storage.commit_root_address(ref.address)
+        storage.unlock()
+
+    def hold_lock(self):
+        """Keep the lock taken by the first write across commits, e.g. for a session."""
+        self._storage.hold_lock()
+
+    def release_lock(self):
+        self._storage.release_lock()
 
     def _refresh_tree_ref(self):
-        self._tree_ref = self.node_ref_class(self._storage.get_root_address())
+        """Point at the committed root, keeping loaded nodes if it has not moved.
+
+        A ref without an address is replaced even when the database is empty:
+        it holds uncommitted changes, or nothing worth keeping.
+        """
+        address = self._storage.get_root_address()
+        ref = self._tree_ref
+        if ref is None or ref.address is None or ref.address != address:
+            self._tree_ref = self.node_ref_class(address=address)
 
     def _follow(self, ref):
-        return ref.get()
+        return ref.get(self._storage)
@@ -1,54 +1,327 @@
 # storage.py
+import collections
+import errno
+import mmap
 import os
-import pickle
+import struct
+
+# Bytes reserved at the start of the file for the root address and the end of
+# the committed records: one whole sector, so rewriting it is atomic on
+# practically every block device
+ROOT_BLOCK_SIZE = 512
+_MAGIC = b"DBDB"
+_VERSION = 1  # Bumped whenever the on-disk format changes
+_PREAMBLE = struct.Struct(">4sI")  # Magic, format version
+# Magic, format version, root address, end of committed records
+_ROOT_HEADER = struct.Struct(">4sIQQ")
+_ADDRESS = struct.Struct(">Q")
+_ROOT_OFFSET = _PREAMBLE.size  # Where the root address sits in the header
+_END_OFFSET = _ROOT_OFFSET + _ADDRESS.size
+
+# Disk space is preallocated in chunks of at least this size, doubling as the
+# file grows, so appends rarely change the file size (an inode update)
+_MIN_RESERVE = 1 << 20
+
+_LENGTH = struct.Struct(">I")  # Length prefix written in front of every record
+
+# Files with up to this much committed data have it read ahead when mapped,
+# saving a disk read per node on the first lookups; larger files are read on
+# demand
+_PREFETCH_LIMIT = 1 << 20
+
+# Decoded records kept by load(); larger records are not worth pinning
+_LOAD_CACHE_SIZE = 1024
+_LOAD_CACHE_MAX_RECORD = 64 * 1024
+
+# fdatasync skips the metadata-only update that fsync forces; not every platform has it
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+# "sync" syncs on commits as sync_every says; "writeback" only syncs on close
+DURABILITY_MODES = ("sync", "writeback")
 
 
 class Storage:
     """Handles low-level file operations"""
 
-    def __init__(self, fileobj):
+    def __init__(self, fileobj, sync_every=1, durability="sync"):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability!r}")
+        if sync_every < 1:
+            raise ValueError(f"sync_every must be at least 1, not {sync_every!r}")
         self._file = fileobj
+        self._fd = fileobj.fileno()
         self.closed = False
+        self._sync_every = sync_every  # Sync on every Nth commit_root_address
+        self._writeback = durability == "writeback"  # Leave syncing to close()
+        self._pending_commits = 0
+        self._root_block = bytearray(ROOT_BLOCK_SIZE)  # Reused by every commit
+        self.locked = False
+        self._lock_held = False  # Set by hold_lock(); unlock() then keeps the lock
+        self._fallocate_failed = False  # Set once preallocation is unsupported
+        self._ensure_root_block()
+        self._mm = None
+        self._mm_view = None  # Sliced by read(); one view per mapping
+        self._mm_size = 0
+        self._mm_failed = False  # Set once mapping fails; reads fall back to pread
+        self._load_cache = collections.OrderedDict()
+
+    def _ensure_root_block(self):
+        """Check the root block, writing the first one into an empty file
+
+        The empty file is initialized under the lock, so two processes
+        creating the same database cannot overwrite each other's commits.
+        """
+        if os.fstat(self._fd).st_size == 0:
+            import fcntl
+
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    _ROOT_HEADER.pack_into(
+                        self._root_block, 0, _MAGIC, _VERSION, 0, ROOT_BLOCK_SIZE
+                    )
+                    self._pwrite(self._root_block, 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        preamble = os.pread(self._fd, _PREAMBLE.size, 0)
+        if len(preamble) < _PREAMBLE.size or not preamble.startswith(_MAGIC):
+            raise ValueError("Not a DBDB database file")
+        _, version = _PREAMBLE.unpack(preamble)
+        if version != _VERSION:
+            raise ValueError(f"Unsupported DBDB file format version {version}")
+        self._reserved = os.fstat(self._fd).st_size
+        self._end = self._committed_end()  # Next record goes here
+
+    def _committed_end(self):
+        """Return the end of the committed records, as stored after the root"""
+        (end,) = _ADDRESS.unpack(os.pread(self._fd, _ADDRESS.size, _END_OFFSET))
+        return end
+
+    def _reserve(self, end):
+        """Make sure disk space is allocated for records up to end"""
+        if end <= self._reserved:
+            return
+        reserved = max(end, 2 * self._reserved, _MIN_RESERVE)
+        if not self._fallocate_failed and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self._fd, self._reserved, reserved - self._reserved)
+                self._reserved = reserved
+                return
+            except OSError as e:
+                # Not every filesystem supports it (EINVAL on ZFS, EOPNOTSUPP
+                # on NFS); a full disk may still fit the records themselves
+                if e.errno != errno.ENOSPC:
+                    self._fallocate_failed = True
+        self._reserved = end
 
     def write(self, data: bytes) -> int:
-        """Write data to storage"""
-        self._file.seek(0, os.SEEK_END)
-        address = self._file.tell()
-        self._file.write(data)
+        """Write data to storage as a length-prefixed record"""
+        address = self._end
+        self._reserve(address + _LENGTH.size + len(data))
+        self._pwrite(_LENGTH.pack(len(data)) + data, address)
+        self._end += _LENGTH.size + len(data)
         return address
 
-    def read(self, address: int) -> bytes:
-        """Read data from storage"""
-        self._file.seek(address)
-        return self._file.read()
+    def record_size(self, length: int) -> int:
+        """Return how many bytes a record of length bytes occupies on disk"""
+        return _LENGTH.size + length
+
+    def tell(self) -> int:
+        """Return the address the next write will be stored at"""
+        return self._end
+
+    def write_batch(self, datas: list) -> list:
+        """Append several records with a single write, returning their addresses"""
+        address = self._end
+        pack = _LENGTH.pack
+        parts = []
+        addresses = []
+        for data in datas:
+            # Headers and payloads are joined once, not concatenated per record
+            parts.append(pack(len(data)))
+            parts.append(data)
+            addresses.append(address)
+            address += _LENGTH.size + len(data)
+        self._reserve(address)
+        self._pwrite(b"".join(parts), self._end)
+        self._end = address
+        return addresses
+
+    def _pwrite(self, data, offset):
+        """Write all of data at offset, straight to the OS with no buffering"""
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self._fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _remap(self):
+        """Map the whole file, picking up records appended since the last map
+
+        Returns False if the file cannot be mapped, e.g. on a filesystem
+        without mmap support or when it outgrows a 32-bit address space.
+        """
+        try:
+            mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+            # The mapping covers the preallocated tail too, so only the
+            # committed records are worth asking for up front
+            if self._end <= _PREFETCH_LIMIT:
+                if hasattr(mmap, "MADV_WILLNEED"):
+                    mm.madvise(mmap.MADV_WILLNEED, 0, self._end)
+            # Tree descents hop between scattered records, so readahead
+            # around each fault mostly pulls in pages nobody asked for
+            elif hasattr(mmap, "MADV_RANDOM"):
+                mm.madvise(mmap.MADV_RANDOM)
+        except (OSError, ValueError, OverflowError):
+            self._mm_failed = True
+            return False
+        self._mm = mm
+        self._mm_view = memoryview(mm)
+        self._mm_size = len(mm)
+        return True
+
+    def read(self, address: int) -> memoryview:
+        """Read data from storage
+
+        Returns a zero-copy view of exactly the record stored at address, or
+        the record's bytes read with os.pread if it lies beyond a mapping.
+        """
+        start = address + _LENGTH.size
+        if self._maps(start):
+            (length,) = _LENGTH.unpack_from(self._mm, address)
+            if self._maps(start + length):
+                return self._mm_view[start : start + length]
+        else:
+            (length,) = _LENGTH.unpack(os.pread(self._fd, _LENGTH.size, address))
+        return os.pread(self._fd, length, start)
+
+    def _maps(self, end):
+        """Return whether the mapping reaches end, remapping if it falls short
+
+        Preallocation makes a mapping extend past the records it was made
+        for, so a record appended later can start inside it and end beyond.
+        """
+        if end <= self._mm_size:
+            return True
+        return not self._mm_failed and self._remap() and end <= self._mm_size
+
+    def load(self, address: int, decode):
+        """Return decode(read(address)), reusing recently decoded records
+
+        Records are never modified once written, so a decoded record stays
+        valid for as long as its address is reachable from a committed root.
+        This lets a tree reloaded after another process commits reuse the
+        nodes it still shares with the previous version.
+        """
+        cache = self._load_cache
+        referent = cache.get(address)
+        if referent is not None:
+            cache.move_to_end(address)
+            return referent
+        data = self.read(address)
+        referent = decode(data)
+        if len(data) <= _LOAD_CACHE_MAX_RECORD:
+            cache[address] = referent
+            if len(cache) > _LOAD_CACHE_SIZE:
+                cache.popitem(last=False)
+        return referent
 
     def close(self):
         """Close the storage file"""
         if not self.closed:
-            self._file.close()
-            self.closed = True
+            try:
+                self.sync()
+            finally:
+                if self._mm is not None:
+                    self._mm_view.release()
+                    try:
+                        self._mm.close()
+                    except BufferError:
+                        pass  # A record from read() is still alive; GC unmaps
+                    self._mm = self._mm_view = None
+                self._file.close()
+                self.closed = True
 
     def flush(self):
-        """Flush writes to disk"""
-        self._file.flush()
+        """Flush writes to disk
+
+        Writes bypass Python's buffering, so this only has to sync the file
+        for them to survive a crash rather than just reach the OS page cache.
+        """
+        _datasync(self._fd)
+
+    def sync(self):
+        """Force out commits whose sync was deferred by sync_every or writeback"""
+        if self._pending_commits:
+            self.flush()
+            self._pending_commits = 0
 
     def lock(self):
-        """Prevent other processes from modifying the file."""
+        """Prevent other processes from modifying the file.
+
+        Returns True if the lock was acquired by this call, False if it was
+        already held.
+        """
+        if self.locked:
+            return False
         import fcntl
 
-        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self.locked = True
+        # Other processes may have appended while we were unlocked
+        self._end = self._committed_end()
+        self._reserved = os.fstat(self._fd).st_size
         return True
 
-    def set(self, address, node_ref):
-        """Wrapper to match binary_tree's expected interface"""
-        data = pickle.dumps(node_ref)
-        if address is None:  # New node
-            return self.write(data)
-        else:  # Update existing
-            self._file.seek(address)
-            self._file.write(data)
-            return address
+    def hold_lock(self):
+        """Keep the lock across commits, once taken, until release_lock()
+
+        The lock itself is still only taken by the first lock() call, so a
+        session that never writes never blocks anyone.
+        """
+        self._lock_held = True
+
+    def release_lock(self):
+        """Release a lock kept by hold_lock()"""
+        self._lock_held = False
+        self.unlock()
+
+    def unlock(self):
+        """Release the lock taken by lock(), unless hold_lock() is keeping it"""
+        if self.locked and not self._lock_held:
+            import fcntl
+
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self.locked = False
+
+    def get_root_address(self):
+        """Return the committed root address, or None for an empty database"""
+        (address,) = _ADDRESS.unpack(os.pread(self._fd, _ADDRESS.size, _ROOT_OFFSET))
+        return address or None
 
     def commit_root_address(self, address):
-        self._file.seek(0)
-        self._file.write(address.to_bytes(8, "big"))
+        """Point the database at a new root; None marks it empty
+
+        Records appended before this call are synced first, so the root never
+        points at data that did not reach the disk, and the root itself is
+        synced after. With sync_every > 1 both syncs only happen on every
+        sync_every-th commit (or on sync()/close()): a crash can then lose the
+        commits since the last sync, and the OS may write the root out ahead
+        of the records it points at. In writeback mode only sync()/close()
+        sync, so a power loss or OS crash before close can lose every commit
+        of the session or leave the file inconsistent; the process itself
+        exiting without close() is safe, since the OS keeps the written data.
+        """
+        if not self.locked:
+            raise RuntimeError("commit_root_address() requires the lock")
+        self._pending_commits += 1
+        durable = not self._writeback and self._pending_commits >= self._sync_every
+        if durable:
+            self.flush()
+        _ROOT_HEADER.pack_into(
+            self._root_block, 0, _MAGIC, _VERSION, address or 0, self._end
+        )
+        self._pwrite(self._root_block, 0)
+        if durable:
+            _datasync(self._fd)
+            self._pending_commits = 0
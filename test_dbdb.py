@@ -0,0 +1,270 @@
+import errno
+import os
+import pickle
+import random
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import interface
+
+
+class DBDBTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+
+    def connect(self):
+        db = interface.connect(self.path)
+        self.addCleanup(db.close)
+        return db
+
+    def test_closing_a_reader_keeps_other_commits(self):
+        writer = self.connect()
+        writer["a"] = "1"
+        writer.commit()
+        reader = self.connect()
+        self.assertEqual(reader["a"], "1")
+        writer["b"] = "2"
+        writer.commit()
+        reader.close()
+        self.assertEqual(self.connect()["b"], "2")
+
+    def test_read_only_session_does_not_commit(self):
+        db = self.connect()
+        db["a"] = "1"
+        db.commit()
+        db.close()
+        with mock.patch("storage._datasync") as datasync:
+            with self.connect() as db:
+                self.assertEqual(db["a"], "1")
+                self.assertNotIn("b", db)
+        datasync.assert_not_called()
+
+    def test_record_appended_past_the_mapping_is_read_whole(self):
+        writer = self.connect()
+        writer["a"] = "1"
+        writer.commit()
+        reader = self.connect()
+        self.assertEqual(reader["a"], "1")  # Maps the preallocated file
+        # The last of these records starts inside the mapping and ends past it
+        for n in range(4):
+            writer["a"] = str(n) * 300000
+            writer.commit()
+        self.assertEqual(reader["a"], "3" * 300000)
+
+    def test_failed_write_leaves_nothing_to_commit_past_the_end(self):
+        db = self.connect()
+        db["a"] = "1"
+        db.commit()
+        db["b"] = "2"
+        with mock.patch.object(db._storage, "write_batch", side_effect=OSError):
+            with self.assertRaises(OSError):
+                db.commit()
+        db.close()
+        db = self.connect()
+        self.assertEqual((db["a"], db["b"]), ("1", "2"))
+
+    def test_failed_compact_keeps_the_tree(self):
+        db = self.connect()
+        db["a"] = "1"
+        db.commit()
+        with mock.patch.object(db._storage, "write_batch", side_effect=OSError):
+            with self.assertRaises(OSError):
+                db.compact()
+        db["b"] = "2"
+        db.close()
+        db = self.connect()
+        self.assertEqual((db["a"], db["b"]), ("1", "2"))
+
+    def test_close_while_a_record_is_still_referenced(self):
+        db = self.connect()
+        db["a"] = "1"
+        db.commit()
+        record = db._storage.read(db._storage.get_root_address())
+        db.close()
+        self.assertTrue(db._storage.closed)
+        self.assertGreater(len(record), 0)
+
+    def test_session_read_does_not_wait_for_a_writing_session(self):
+        with self.connect() as writer:
+            writer["a"] = "1"
+            writer.commit()
+            writer["b"] = "2"  # Holds the lock until the session ends
+            result = []
+
+            def read():
+                with interface.connect(self.path) as reader:
+                    result.append(reader["a"])
+
+            thread = threading.Thread(target=read, daemon=True)
+            thread.start()
+            thread.join(5)
+            self.assertEqual(result, ["1"])
+
+    def test_release_lock_drops_uncommitted_changes_on_an_empty_database(self):
+        db = self.connect()
+        db["a"] = "1"
+        db.release_lock()
+        self.assertNotIn("a", db)
+        db["b"] = "2"
+        db.commit()
+        self.assertNotIn("a", self.connect())
+
+    def test_writes_work_without_preallocation(self):
+        error = OSError(errno.EOPNOTSUPP, "Operation not supported")
+        with mock.patch("os.posix_fallocate", side_effect=error, create=True):
+            db = self.connect()
+            for i in range(100):
+                db[i] = "x" * 1000
+                db.commit()
+            db.close()
+        self.assertEqual(self.connect()[99], "x" * 1000)
+
+    def check_tree(self, db):
+        """Assert the treap invariants and return the depth of the tree."""
+        tree = db._tree
+        depth = 0
+        stack = [(tree._follow(tree._tree_ref), None, None, 1)]
+        while stack:
+            node, low, high, level = stack.pop()
+            if node is None:
+                continue
+            depth = max(depth, level)
+            self.assertTrue(low is None or low < node.key)
+            self.assertTrue(high is None or node.key < high)
+            for child_ref, child_low, child_high in (
+                (node.left_ref, low, node.key),
+                (node.right_ref, node.key, high),
+            ):
+                child = tree._follow(child_ref)
+                if child is not None:
+                    self.assertLessEqual(child.priority, node.priority)
+                stack.append((child, child_low, child_high, level + 1))
+        return depth
+
+    def check_contents(self, db, model):
+        for key in range(200):
+            if key in model:
+                self.assertIn(key, db)
+                self.assertEqual(db[key], model[key])
+            else:
+                self.assertNotIn(key, db)
+                with self.assertRaises(KeyError):
+                    db[key]
+
+    def test_random_operations_match_a_dict(self):
+        rng = random.Random(1234)
+        values = ["s", "", b"\x00b", 0, -(1 << 70), None, (1, "t"), [b"p"], 2.5]
+        model = {}
+        db = self.connect()
+        for step in range(3000):
+            key = rng.randrange(200)
+            if rng.random() < 0.3 and key in model:
+                del db[key]
+                del model[key]
+            else:
+                db[key] = model[key] = rng.choice(values)
+            if step % 100 == 99:
+                db.commit()
+            if step % 500 == 499:
+                self.check_contents(db, model)
+                self.check_tree(db)
+            if step % 1000 == 999:
+                db.close()
+                db = self.connect()
+                self.check_contents(db, model)
+                db.compact()
+                self.check_tree(db)
+        for key in list(model):
+            del db[key]
+        db.commit()
+        self.check_contents(db, {})
+
+    def test_sequential_inserts_stay_shallow(self):
+        with self.connect() as db:
+            for key in range(10000):
+                db[key] = key
+        db = self.connect()
+        # A treap's expected depth is about 3 ln n, near 28 here
+        self.assertLess(self.check_tree(db), 60)
+        db.compact()
+        self.assertEqual(self.check_tree(db), 14)  # Perfectly balanced
+
+    def test_missing_keys_raise_but_none_values_are_present(self):
+        db = self.connect()
+        db["a"] = None
+        db.commit()
+        self.assertIsNone(db["a"])
+        self.assertIn("a", db)
+        self.assertNotIn("b", db)
+        with self.assertRaises(KeyError):
+            db["b"]
+        with self.assertRaises(KeyError):
+            del db["b"]
+
+    def test_reads_and_writes_without_mmap(self):
+        with mock.patch("mmap.mmap", side_effect=OSError):
+            db = self.connect()
+            for i in range(50):
+                db[i] = str(i)
+            db.commit()
+            db.close()
+            db = self.connect()
+            self.assertEqual([db[i] for i in range(50)], [str(i) for i in range(50)])
+            db[50] = "50"
+            db.commit()
+            self.assertEqual(db[50], "50")
+            self.assertIsNone(db._storage._mm)
+
+    def count_syncs(self, commits, **kwargs):
+        """Return the syncs made by that many commits, and then by close()."""
+        with mock.patch("storage._datasync") as datasync:
+            db = interface.connect(self.path, **kwargs)
+            for i in range(commits):
+                db[i] = str(i)
+                db.commit()
+            before_close = datasync.call_count
+            db.close()
+        return before_close, datasync.call_count
+
+    def test_sync_every_defers_syncs(self):
+        # Commits 3 and 6 sync the records and then the root; close syncs the 7th
+        self.assertEqual(self.count_syncs(7, sync_every=3), (4, 5))
+        self.assertEqual(self.count_syncs(2), (4, 4))
+
+    def test_writeback_syncs_only_on_close(self):
+        self.assertEqual(self.count_syncs(7, durability="writeback"), (0, 1))
+
+    def test_sync_every_must_be_positive(self):
+        for sync_every in (0, -1):
+            with self.assertRaises(ValueError):
+                interface.connect(self.path, sync_every=sync_every)
+
+    def test_new_file_gets_a_root_block(self):
+        self.connect().close()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(4), b"DBDB")
+
+    def test_files_without_the_magic_are_refused_untouched(self):
+        data = pickle.dumps({"key": "value"})  # What the original format wrote
+        with open(self.path, "wb") as f:
+            f.write(data)
+        with self.assertRaises(ValueError):
+            interface.connect(self.path)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_unknown_versions_are_refused(self):
+        self.connect().close()
+        with open(self.path, "r+b") as f:
+            f.seek(4)
+            f.write((99).to_bytes(4, "big"))
+        with self.assertRaises(ValueError):
+            interface.connect(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import contextlib
+import fcntl
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import interface
+import tool
+
+
+class ToolTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.realpath(os.path.join(self.dir.name, "t.db"))
+
+    def connect(self):
+        db = interface.connect(self.path)
+        self.addCleanup(db.close)
+        return db
+
+    def answer(self, db, message):
+        return tool.answer(db, self.path, json.dumps(message))
+
+    def assertUnlocked(self):
+        with open(self.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_batch_reports_bad_lines_and_runs_the_rest(self):
+        lines = ['set a 1\n', 'set "b 2\n', "set c 3 junk\n", "get a\n"]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+            with self.connect() as db:
+                self.assertEqual(tool.run_batch(db, lines), 1)
+        self.assertEqual(out.getvalue(), "Set a = 1\n1\n")
+        self.assertNotIn("c", self.connect())
+
+    def test_answer_runs_commands(self):
+        db = self.connect()
+        reply = self.answer(db, [self.path, "set", "a", "1"])
+        self.assertEqual(reply, {"status": 0, "out": "Set a = 1\n", "err": ""})
+        reply = self.answer(db, [self.path, "get", "a", None])
+        self.assertEqual(reply, {"status": 0, "out": "1\n", "err": ""})
+        reply = self.answer(db, [self.path, "get", "b", None])
+        self.assertEqual(reply["status"], 1)
+        self.assertUnlocked()
+
+    def test_answer_rejects_malformed_json(self):
+        reply = tool.answer(self.connect(), self.path, "not json\n")
+        self.assertEqual(reply["status"], 1)
+        self.assertTrue(reply["err"].startswith("Error:"))
+
+    def test_answer_rejects_non_string_key(self):
+        db = self.connect()
+        reply = self.answer(db, [self.path, "set", 5, "x"])
+        self.assertEqual(reply["status"], 1)
+        self.assertUnlocked()
+
+    def test_answer_unlocks_after_a_failed_write(self):
+        db = self.connect()
+        db[1] = "one"  # An int key makes setting a str key fail mid-insert
+        db.commit()
+        reply = self.answer(db, [self.path, "set", "k", "v"])
+        self.assertEqual(reply["status"], 1)
+        self.assertUnlocked()
+        self.assertEqual(db[1], "one")
+
+    def test_answer_leaves_other_files_to_the_client(self):
+        db = self.connect()
+        reply = self.answer(db, [self.path + ".other", "set", "a", "1"])
+        self.assertIsNone(reply["status"])
+        self.assertNotIn("a", db)
+
+    def test_daemon_round_trip(self):
+        socket_path = os.path.join(self.dir.name, "t.sock")
+        env = dict(os.environ, **{tool.SOCKET_ENV: socket_path})
+        daemon = subprocess.Popen(
+            [sys.executable, tool.__file__, self.path, "daemon"], env=env
+        )
+        self.addCleanup(daemon.wait)
+        self.addCleanup(daemon.terminate)
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket_path):
+            self.assertLess(time.monotonic(), deadline, "daemon did not start")
+            time.sleep(0.01)
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(tool.request(socket_path, self.path, "set", "a", "1"), 0)
+            self.assertEqual(tool.request(socket_path, self.path, "get", "a", None), 0)
+        self.assertEqual(out.getvalue(), "Set a = 1\n1\n")
+        self.assertIsNone(tool.request(socket_path, self.path + ".x", "get", "a", None))
+
+        daemon.terminate()
+        daemon.wait(10)
+        self.assertFalse(os.path.exists(socket_path))
+        self.assertEqual(self.connect()["a"], "1")
+
+
+if __name__ == "__main__":
+    unittest.main()
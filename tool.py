@@ -1,53 +1,273 @@
+import os
+import shlex
 import sys
 import interface
 
+BATCH_COMMIT_EVERY = 1000  # Operations between commits in batch mode
+BATCH_OUTPUT_SIZE = 64 * 1024  # Characters of batch output written at once
+SOCKET_ENV = "DBDB_SOCKET"  # Unix socket of a running daemon, if set
+CLIENT_TIMEOUT = 1.0  # Seconds the daemon waits on a client before dropping it
+
 
 def usage():
     print("Usage:", file=sys.stderr)
     print(f"  {sys.argv[0]} <filename> get <key>", file=sys.stderr)
     print(f"  {sys.argv[0]} <filename> set <key> <value>", file=sys.stderr)
     print(f"  {sys.argv[0]} <filename> delete <key>", file=sys.stderr)
+    print(f"  {sys.argv[0]} <filename> batch", file=sys.stderr)
+    print("    (reads 'get <key>', 'set <key> <value>' and 'delete <key>'", file=sys.stderr)
+    print("    commands from stdin, one per line)", file=sys.stderr)
+    print(f"  {sys.argv[0]} <filename> daemon", file=sys.stderr)
+    print(f"    (serves commands on the unix socket named by ${SOCKET_ENV};", file=sys.stderr)
+    print("    get, set and delete use it whenever the variable is set)", file=sys.stderr)
+    print("Options (before <filename>):", file=sys.stderr)
+    print("  --writeback  skip syncing until the database is closed;", file=sys.stderr)
+    print("               a crash can lose or corrupt this run's writes", file=sys.stderr)
+
+
+def check_command(verb, key, value):
+    """Return an error message for an invalid command, or None."""
+    if verb not in {"get", "set", "delete"} or key is None:
+        return f"Invalid command: {verb}"
+    if verb == "set" and value is None:
+        return "'set' operation requires a value"
+    if verb != "set" and value is not None:
+        return f"'{verb}' operation takes no value"
+    return None
+
+
+def run(db, verb, key, value, write=None, error=None):
+    """Execute one command against an open database and return an exit code.
+
+    Output goes to write and error messages to error, which default to
+    sys.stdout.write and sys.stderr.write.
+    """
+    if write is None:
+        write = sys.stdout.write
+    if error is None:
+        error = sys.stderr.write
+    if verb == "get":
+        try:
+            write(f"{db[key]}\n")
+        except KeyError:
+            error(f"Error: Key '{key}' not found\n")
+            return 1
+    elif verb == "set":
+        db[key] = value
+        write(f"Set {key} = {value}\n")
+    elif verb == "delete":
+        try:
+            del db[key]
+            write(f"Deleted key: {key}\n")
+        except KeyError:
+            error(f"Error: Key '{key}' not found\n")
+            return 1
+    return 0
+
+
+def run_batch(db, lines):
+    """Run one command per line on a single connection, committing periodically.
+
+    Output is collected and written in chunks of BATCH_OUTPUT_SIZE rather
+    than once per command.
+    """
+    status = 0
+    pending = 0
+    out = []
+    out_size = 0
+
+    def write(text):
+        nonlocal out_size
+        out.append(text)
+        out_size += len(text)
+        if out_size >= BATCH_OUTPUT_SIZE:
+            sys.stdout.write("".join(out))
+            out.clear()
+            out_size = 0
+
+    for line in lines:
+        try:
+            parts = shlex.split(line)
+        except ValueError as e:  # e.g. an unclosed quote
+            print(f"Error: {str(e)}: {line.rstrip()}", file=sys.stderr)
+            status = 1
+            continue
+        if not parts:
+            continue
+        verb = parts[0]
+        key = parts[1] if len(parts) > 1 else None
+        value = parts[2] if len(parts) > 2 else None
+        if len(parts) > 3:
+            error = f"Too many arguments: {line.rstrip()}"
+        else:
+            error = check_command(verb, key, value)
+        if error:
+            print(f"Error: {error}", file=sys.stderr)
+            status = 1
+            continue
+        status = run(db, verb, key, value, write) or status
+        if verb != "get":
+            pending += 1
+            if pending >= BATCH_COMMIT_EVERY:
+                db.commit()
+                pending = 0
+    db.commit()
+    sys.stdout.write("".join(out))
+    return status
+
+
+def serve(db, dbname, path):
+    """Answer commands from clients on a unix socket at path until interrupted.
+
+    Each connection carries one JSON line [dbname, verb, key, value] and gets
+    back one JSON line with the exit status and the command's output; the
+    status is null for requests naming another file, which the client then
+    opens itself. Writes are committed before replying, as in single-command
+    mode.
+    """
+    # Imported here so plain CLI runs start without the socket machinery
+    import json
+    import signal
+    import socket
+
+    dbname = os.path.realpath(dbname)
+    # Stop through the finally below on kill as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+    except OSError:
+        server.close()
+        raise
+    try:
+        server.listen()
+        while True:
+            conn, _ = server.accept()
+            # Clients are served one at a time, so a silent one must not stall the rest
+            conn.settimeout(CLIENT_TIMEOUT)
+            try:
+                with conn, conn.makefile("rwb") as stream:
+                    reply = answer(db, dbname, stream.readline())
+                    stream.write(json.dumps(reply).encode() + b"\n")
+            except OSError:
+                pass  # The client hung up; keep serving the others
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def answer(db, dbname, line):
+    """Run the command in one daemon request line and return the reply."""
+    import json
+
+    out = []
+    err = []
+    try:
+        message = json.loads(line)
+        if (
+            not isinstance(message, list)
+            or len(message) != 4
+            or not all(isinstance(field, str) for field in message[:3])
+            or not isinstance(message[3], (str, type(None)))
+        ):
+            raise ValueError("Malformed request")
+        name, verb, key, value = message
+        if name != dbname:
+            # Tells the client to open its file directly
+            return {"status": None, "out": "", "err": ""}
+        error = check_command(verb, key, value)
+        if error:
+            err.append(f"Error: {error}\n")
+            status = 1
+        else:
+            try:
+                status = run(db, verb, key, value, out.append, err.append)
+                if verb != "get":
+                    db.commit()
+            finally:
+                # A failed write must not leave the file locked for everyone
+                db.release_lock()
+    except Exception as e:
+        err.append(f"Error: {str(e)}\n")
+        status = 1
+    return {"status": status, "out": "".join(out), "err": "".join(err)}
+
+
+def request(path, dbname, verb, key, value):
+    """Send one command to the daemon listening at path and relay its reply.
+
+    Returns the command's exit status, or None without running it if the
+    daemon serves a different file.
+    """
+    import json
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        with client.makefile("rwb") as stream:
+            message = [os.path.realpath(dbname), verb, key, value]
+            stream.write(json.dumps(message).encode() + b"\n")
+            stream.flush()
+            reply = json.loads(stream.readline())
+    if reply["status"] is None:
+        return None
+    sys.stdout.write(reply["out"])
+    sys.stderr.write(reply["err"])
+    return reply["status"]
 
 
 def main(argv):
+    durability = "sync"
+    if len(argv) > 1 and argv[1] == "--writeback":
+        durability = "writeback"
+        argv = argv[:1] + argv[2:]
     try:
-        if len(argv) < 4:
+        if len(argv) == 3 and argv[2] == "batch":
+            with interface.connect(argv[1], durability=durability) as db:
+                return run_batch(db, sys.stdin)
+
+        if len(argv) == 3 and argv[2] == "daemon":
+            path = os.environ.get(SOCKET_ENV)
+            if not path:
+                print(f"Error: 'daemon' requires ${SOCKET_ENV}", file=sys.stderr)
+                return 1
+            # No session lock: other processes can still open the file
+            db = interface.connect(argv[1], durability=durability)
+            try:
+                return serve(db, argv[1], path)
+            finally:
+                db.close()
+
+        if not 4 <= len(argv) <= 5:
             usage()
             return 1
 
         dbname, verb, key = argv[1:4]
         value = argv[4] if len(argv) > 4 else None
 
-        if verb not in {"get", "set", "delete"}:
+        error = check_command(verb, key, value)
+        if error:
+            print(f"Error: {error}", file=sys.stderr)
             usage()
             return 1
 
-        if verb == "set" and value is None:
-            print("Error: 'set' operation requires a value", file=sys.stderr)
-            usage()
-            return 1
+        path = os.environ.get(SOCKET_ENV)
+        if path:
+            try:
+                status = request(path, dbname, verb, key, value)
+            except (FileNotFoundError, ConnectionRefusedError):
+                status = None  # No daemon listening
+            if status is not None:
+                return status
+            # Otherwise open the file directly
 
-        with interface.connect(dbname) as db:
-            if verb == "get":
-                try:
-                    print(db[key])
-                except KeyError:
-                    print(f"Error: Key '{key}' not found", file=sys.stderr)
-                    return 1
-            elif verb == "set":
-                db[key] = value
+        with interface.connect(dbname, durability=durability) as db:
+            status = run(db, verb, key, value)
+            if verb != "get":
                 db.commit()
-                print(f"Set {key} = {value}")
-            elif verb == "delete":
-                try:
-                    del db[key]
-                    db.commit()
-                    print(f"Deleted key: {key}")
-                except KeyError:
-                    print(f"Error: Key '{key}' not found", file=sys.stderr)
-                    return 1
-
-        return 0
+            return status
     except Exception as e:
         print(f"Error: {str(e)}", file=sys.stderr)
         return 1